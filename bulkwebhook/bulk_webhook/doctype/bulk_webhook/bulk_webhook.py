@@ -4,12 +4,17 @@
 from __future__ import unicode_literals
 from datetime import timedelta
 import datetime
+import http.cookiejar
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
 import hashlib
 import hmac
 import json
-from time import sleep
+import random
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import frappe
 from frappe import _
 from frappe.model.document import Document
@@ -23,9 +28,71 @@ from frappe.utils.jinja import validate_template
 from frappe.utils.safe_exec import get_safe_globals, NamespaceDict, safe_exec
 from types import FunctionType, MethodType, ModuleType
 from bulkwebhook.bulk_webhook.doctype.kafka_settings.kafka_utlis import send_kafka
+import orjson
 
 
 WEBHOOK_SECRET_HEADER = "X-Frappe-Webhook-Signature"
+DATETIME_TYPES = (datetime.datetime, datetime.time, datetime.date, datetime.timedelta)
+MAX_CONCURRENT_REQUESTS = 16
+DISPATCH_SAVEPOINT = "bulk_webhook_dispatch"
+MAX_RETRY_AFTER = 10
+
+# Autocompletion scores for the common exact value types, checked before
+# falling back to the isinstance checks in get_autocompletion_score
+AUTOCOMPLETION_SCORES = {
+    ModuleType: 10,
+    FunctionType: 9,
+    MethodType: 9,
+    dict: 7,
+}
+
+
+
+class _WebhookRetry(Retry):
+    """Retry with jittered exponential backoff and a capped Retry-After wait."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        # "equal jitter", so webhooks failing together don't retry in lockstep
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER)
+
+
+# Shared HTTP session so that connections (and TLS handshakes) are reused
+# across retries and across the webhooks sent within one job (RQ forks a
+# fresh process per job). Cookies are never stored, so a Set-Cookie from one
+# endpoint is not sent along with later webhooks or for other sites.
+# Only transient failures are retried, with jittered exponential backoff, and
+# a server's Retry-After is honoured up to MAX_RETRY_AFTER seconds. The last
+# response is returned rather than raised so that its status and body can be
+# logged.
+_RETRY = _WebhookRetry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["POST", "PUT", "GET", "PATCH"]),
+    raise_on_status=False,
+)
+_SESSION = requests.Session()
+_SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_RETRY)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+
+def _dumps(obj, indent=False):
+    """Serializes `obj` to JSON bytes with orjson. These are the bytes that are
+    signed and sent, so they must not depend on the environment. Non-string
+    dict keys are converted to strings, as json.dumps does."""
+    option = orjson.OPT_NON_STR_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=str, option=option)
 
 
 class BulkWebhook(Document):
@@ -75,8 +142,9 @@ class BulkWebhook(Document):
     def get_report_data(self, report_filters=None):
         """Returns file in for the report in given format"""
         report = frappe.get_doc("Report", self.report)
-        self.filters = report_filters
-        if not self.filters:
+        if report_filters:
+            self.filters = report_filters
+        if not isinstance(self.filters, dict):
             self.filters = frappe.parse_json(self.filters) if self.filters else {}
 
         if self.report_type == "Report Builder" and self.data_modified_till:
@@ -95,19 +163,18 @@ class BulkWebhook(Document):
             ignore_prepared_report=True,
         )
 
-        # add serial numbers
-        columns.insert(0, frappe._dict(fieldname="idx", label="", width="30px"))
-        for i in range(len(data)):
-            data[i]["idx"] = i + 1
-
-        if len(data) == 0 and self.send_if_data:
+        if not data and self.send_if_data:
             return None
 
+        # add serial numbers, only if the template can use them
+        if not self.webhook_json or "idx" in self.webhook_json:
+            columns.insert(0, frappe._dict(fieldname="idx", label="", width="30px"))
+            for i, row in enumerate(data, 1):
+                row["idx"] = i
+
         return data
 
     def prepare_dynamic_filters(self):
-        self.filters = frappe.parse_json(self.filters)
-
         to_date = today()
         from_date_value = {
             "Daily": ("days", -1),
@@ -127,6 +194,8 @@ class BulkWebhook(Document):
         if self.filter_meta and not self.filters:
             frappe.throw(_("Please set filters value in Report Filter table."))
 
+        # serialize before get_webhook_data updates the filters in place
+        doc_json = frappe.as_json(self.as_dict())
         data_list = get_webhook_data(self)
 
         if not data_list or len(data_list) == 0:
@@ -139,6 +208,7 @@ class BulkWebhook(Document):
             timeout=10000,
             is_async=True,
             bulk_webhook_name=self.name,
+            doc_json=doc_json,
             job_name="Bulk Webhook: " + self.title,
         )
 
@@ -160,44 +230,32 @@ def get_context(data):
 
 
 def enqueue_bulk_webhook(
-    bulk_webhook_name, method_parameters=None, report_filters=None
+    bulk_webhook_name=None, method_parameters=None, report_filters=None, doc_json=None
 ):
-    webhook = frappe.get_cached_doc("Bulk Webhook", bulk_webhook_name)
-    headers = get_webhook_headers(webhook)
+    """Sends the Bulk Webhook. `doc_json` (a serialized Bulk Webhook) can be
+    passed instead of loading the document by `bulk_webhook_name`."""
+    if doc_json:
+        webhook = frappe.get_doc(json.loads(doc_json))
+    else:
+        webhook = frappe.get_cached_doc("Bulk Webhook", bulk_webhook_name)
     data_list = get_webhook_data(webhook, method_parameters, report_filters)
     if not data_list or len(data_list) == 0:
         return
-    url = webhook.request_url
-
-    if not url:
-        url = frappe.get_cached_value("Bulk Webhook Settings", "Bulk Webhook Settings", "url")
     if webhook.request_type == "API":
-        for data_row in data_list:
-            for i in range(3):
-                r = {}
-                try:
-                    r = requests.request(
-                        method=webhook.request_method,
-                        url=url,
-                        data=json.dumps(data_row[1], default=str),
-                        headers=headers,
-                        timeout=5,
-                    )
-                    r.raise_for_status()
-                    frappe.logger().debug({"webhook_success": r.text})
-                    log_request(url, headers, data_row[1], r.json())
-                    return r.json()
-                except Exception as e:
-                    frappe.logger().debug({"webhook_error": e, "try": i + 1})
-                    log_request(url, headers, data_row[1], r.json())
-                    sleep(3 * i + 1)
-                    if i != 2:
-                        continue
-                    else:
-                        raise e
+        req = _build_api_request(webhook, data_list)
+        r, error = _send_request(req.method, req.url, req.payload, req.headers)
+        response = get_response_data(r)
+        log_request(req.url, req.headers, req.data, response)
+        if error:
+            frappe.logger().debug({"webhook_error": error})
+            # the job is rolled back on error, keep the request log
+            frappe.db.commit()
+            raise error
+        frappe.logger().debug({"webhook_success": r.text})
+        return response
     elif webhook.request_type == "Kafka":
         for data_row in data_list:
-            r = {}
+            r = None
             try:
                 r = send_kafka(
                     webhook.kafka_settings,
@@ -226,17 +284,106 @@ def enqueue_bulk_webhooks(frequency):
     webhooks = frappe.get_all(
         "Bulk Webhook",
         filters={"enabled": 1, "frequency": frequency},
-        fields=["name", "title"],
+        pluck="name",
     )
-    for webhook in webhooks:
-        enqueue(
-            method=enqueue_bulk_webhook,
-            queue="long",
-            timeout=10000,
-            is_async=True,
-            bulk_webhook_name=webhook.name,
-            job_name="Bulk Webhook: " + webhook.title,
+    if not webhooks:
+        return
+    enqueue(
+        method=dispatch_bulk_webhooks,
+        queue="long",
+        timeout=10000,
+        is_async=True,
+        bulk_webhook_names=webhooks,
+        job_name="Bulk Webhooks: " + frequency,
+    )
+
+
+def dispatch_bulk_webhooks(bulk_webhook_names):
+    """Sends the given Bulk Webhooks from a single job.
+
+    Webhook data is prepared on this thread (it needs the database) and each
+    API request is handed to a thread pool as soon as it is built, so a slow
+    report does not hold back webhooks that are already prepared. Responses
+    are logged on this thread as they complete. Kafka webhooks are sent as
+    before.
+    """
+    pending = []
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        for name in bulk_webhook_names:
+            pending = _log_api_results(pending)
+            # isolate each webhook's writes, as when each ran in its own job
+            frappe.db.savepoint(DISPATCH_SAVEPOINT)
+            try:
+                webhook = frappe.get_cached_doc("Bulk Webhook", name)
+                if webhook.request_type != "API":
+                    enqueue_bulk_webhook(name)
+                    continue
+                data_list = get_webhook_data(webhook)
+                if not data_list:
+                    continue
+                req = _build_api_request(webhook, data_list)
+                future = executor.submit(
+                    _send_request, req.method, req.url, req.payload, req.headers
+                )
+                pending.append((req, future))
+            except Exception as e:
+                frappe.db.rollback(save_point=DISPATCH_SAVEPOINT)
+                frappe.log_error(
+                    frappe.get_traceback(), str(name + ": " + str(e))[0:140]
+                )
+
+        _log_api_results(pending, wait=True)
+
+
+def _log_api_results(pending, wait=False):
+    """Logs the requests in `pending` that have completed (all of them if
+    `wait` is set) and returns the ones that are still running."""
+    still_pending = []
+    for req, future in pending:
+        if not wait and not future.done():
+            still_pending.append((req, future))
+            continue
+        r, error = future.result()
+        log_request(req.url, req.headers, req.data, get_response_data(r))
+        if error:
+            frappe.log_error(
+                "".join(
+                    traceback.format_exception(
+                        type(error), error, error.__traceback__
+                    )
+                ),
+                str(req.title + ": " + str(error))[0:140],
+            )
+    return still_pending
+
+
+def _build_api_request(webhook, data_list):
+    """Returns the request to send for an API webhook. Only the first row of
+    `data_list` is sent."""
+    data_row = data_list[0]
+    payload = _dumps(data_row[1])
+    return frappe._dict(
+        title=webhook.title,
+        method=webhook.request_method,
+        url=webhook.request_url or _settings_cache().get("url"),
+        payload=payload,
+        headers=get_webhook_headers(webhook, payload),
+        data=data_row[1],
+    )
+
+
+def _send_request(method, url, payload, headers):
+    """Sends a webhook request and returns a `(response, error)` tuple.
+    Does not touch the database, so it is safe to call from worker threads."""
+    r = None
+    try:
+        r = _SESSION.request(
+            method=method, url=url, data=payload, headers=headers, timeout=5
         )
+        r.raise_for_status()
+        return r, None
+    except Exception as e:
+        return r, e
 
 
 def log_request(url, headers, data, res):
@@ -245,39 +392,68 @@ def log_request(url, headers, data, res):
             "doctype": "Webhook Request Log",
             "user": frappe.session.user if frappe.session.user else None,
             "url": url,
-            "headers": json.dumps(headers, indent=4) if headers else None,
-            "data": json.dumps(data, indent=4) if isinstance(data, dict) else data,
-            "response": json.dumps(res, indent=4) if res else None,
+            "headers": _dumps(headers, indent=True).decode() if headers else None,
+            "data": _dumps(data, indent=True).decode()
+            if isinstance(data, dict)
+            else data,
+            "response": _dumps(res, indent=True).decode() if res else None,
         }
     )
 
     request_log.insert(ignore_permissions=True)
-    frappe.db.commit()
 
 
-def get_webhook_headers(webhook):
+def get_response_data(res):
+    """Returns the JSON body of the response, or its text if it is not JSON.
+    Returns None if no response was received."""
+    if res is None:
+        return None
+    try:
+        return res.json()
+    except ValueError:
+        return res.text
+
+
+def _get_settings():
+    settings = frappe.get_single("Bulk Webhook Settings")
+    return {
+        "url": settings.url,
+        "headers": [{"key": h.key, "value": h.value} for h in settings.headers],
+    }
+
+
+def _settings_cache():
+    """Returns Bulk Webhook Settings as a dict, cached in redis until the
+    settings document is updated."""
+    return frappe.cache().get_value(
+        "bulk_webhook_settings_cache", generator=_get_settings
+    )
+
+
+def _compute_signature(secret, payload_bytes):
+    return base64.b64encode(
+        hmac.new(secret.encode("utf8"), payload_bytes, hashlib.sha256).digest()
+    ).decode()
+
+
+def get_webhook_headers(webhook, payload):
+    """Returns request headers for the webhook, signing `payload` (the exact
+    bytes that will be sent) when security is enabled."""
     headers = {}
     if webhook.enable_security:
-        data = get_webhook_data(webhook)
-        signature = base64.b64encode(
-            hmac.new(
-                webhook.get_password("webhook_secret").encode("utf8"),
-                json.dumps(data).encode("utf8"),
-                hashlib.sha256,
-            ).digest()
+        headers[WEBHOOK_SECRET_HEADER] = _compute_signature(
+            webhook.get_password("webhook_secret"), payload
         )
-        headers[WEBHOOK_SECRET_HEADER] = signature
 
-    if webhook.webhook_headers:
-        for h in webhook.webhook_headers:
-            if h.get("key") and h.get("value"):
-                headers[h.get("key")] = h.get("value")
-    else:
-        settings = frappe.get_single("Bulk Webhook Settings")
-        if settings.headers:
-            for h in settings.headers:
-                if h.get("key") and h.get("value"):
-                    headers[h.get("key")] = h.get("value")
+    # per-webhook headers take precedence; settings are only read without them
+    header_rows = webhook.webhook_headers or _settings_cache().get("headers") or []
+    headers.update(
+        {
+            h.get("key"): h.get("value")
+            for h in header_rows
+            if h.get("key") and h.get("value")
+        }
+    )
 
     return headers
 
@@ -292,24 +468,22 @@ def get_webhook_data(webhook, method_parameters=None, report_filters=None):
         _data = webhook.get_script_data()
     if not _data:
         return
+    if webhook.source != "Report":
+        # rows returned by a method or script may be shared, don't modify them
+        _data = [rec.copy() for rec in _data]
     group_dict = {}
     data_list = []
+    group_by = webhook.group_by
     for rec in _data:
-        copy_rec = rec.copy()
+        # Convert datetime objects to string in place
         for key, value in rec.items():
-            # Convert datetime object to string
-            if isinstance(
-                value,
-                (datetime.datetime, datetime.time, datetime.date, datetime.timedelta),
-            ):
-                copy_rec[key] = str(value)
-        if webhook.group_by:
-            if rec.get(webhook.group_by):
-                group_dict.setdefault(rec.get(webhook.group_by), [])
-                group_dict[rec.get(webhook.group_by)].append(copy_rec)
+            if isinstance(value, DATETIME_TYPES):
+                rec[key] = str(value)
+        if group_by:
+            if rec.get(group_by):
+                group_dict.setdefault(rec.get(group_by), []).append(rec)
         else:
-            group_dict.setdefault("None", [])
-            group_dict["None"].append(copy_rec)
+            group_dict.setdefault("None", []).append(rec)
 
     for key, value in group_dict.items():
         data = None
@@ -323,6 +497,20 @@ def get_webhook_data(webhook, method_parameters=None, report_filters=None):
     return data_list
 
 
+def get_autocompletion_score(value):
+    if isinstance(value, type) and issubclass(value, Exception):
+        return 0
+    elif isinstance(value, ModuleType):
+        return 10
+    elif isinstance(value, (FunctionType, MethodType)):
+        return 9
+    elif isinstance(value, type):
+        return 8
+    elif isinstance(value, dict):
+        return 7
+    return 6
+
+
 @frappe.whitelist()
 def get_autocompletion_items():
     """Generates a list of a autocompletion strings from the context dict
@@ -347,18 +535,9 @@ def get_autocompletion_items():
                     fullkey = f"{key}.{subkey}"
                     out.append([fullkey, score])
             else:
-                if isinstance(value, type) and issubclass(value, Exception):
-                    score = 0
-                elif isinstance(value, ModuleType):
-                    score = 10
-                elif isinstance(value, (FunctionType, MethodType)):
-                    score = 9
-                elif isinstance(value, type):
-                    score = 8
-                elif isinstance(value, dict):
-                    score = 7
-                else:
-                    score = 6
+                score = AUTOCOMPLETION_SCORES.get(type(value))
+                if score is None:
+                    score = get_autocompletion_score(value)
                 out.append([key, score])
         return out
 
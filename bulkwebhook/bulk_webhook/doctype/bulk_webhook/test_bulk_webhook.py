@@ -1,9 +1,300 @@
 # Copyright (c) 2021, Aakvatech and Contributors
 # See license.txt
 
-# import frappe
+import base64
+import datetime
+import hashlib
+import hmac
+import json
 import unittest
+from contextlib import ExitStack
+from http.client import HTTPMessage
+from unittest.mock import MagicMock, patch
+
+import requests
+from requests.cookies import extract_cookies_to_jar
+from urllib3.util.retry import Retry
+
+import frappe
+from bulkwebhook.bulk_webhook.doctype.bulk_webhook.bulk_webhook import (
+    DISPATCH_SAVEPOINT,
+    MAX_RETRY_AFTER,
+    WEBHOOK_SECRET_HEADER,
+    BulkWebhook,
+    _RETRY,
+    _SESSION,
+    _compute_signature,
+    _dumps,
+    dispatch_bulk_webhooks,
+    enqueue_bulk_webhook,
+    get_response_data,
+    get_webhook_data,
+    get_webhook_headers,
+)
+
+MODULE = "bulkwebhook.bulk_webhook.doctype.bulk_webhook.bulk_webhook"
+
+
+def make_api_webhook(name):
+    return frappe._dict(
+        name=name,
+        title=name,
+        request_type="API",
+        request_method="POST",
+        request_url="https://example.com/" + name,
+        enable_security=0,
+        webhook_headers=[],
+    )
+
+
+def dispatch(webhook_data):
+    """Runs dispatch_bulk_webhooks for API webhooks named after the keys of
+    `webhook_data`, whose values are the data lists (or the exception) that
+    get_webhook_data returns for them."""
+    webhooks = {name: make_api_webhook(name) for name in webhook_data}
+
+    def get_webhook_data(webhook):
+        data = webhook_data[webhook.name]
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    response = MagicMock()
+    response.json.return_value = {"success": True}
+    with ExitStack() as stack:
+        mocks = frappe._dict(
+            request=stack.enter_context(
+                patch.object(_SESSION, "request", return_value=response)
+            ),
+            log_request=stack.enter_context(patch(MODULE + ".log_request")),
+            db=stack.enter_context(patch("frappe.db")),
+            log_error=stack.enter_context(patch("frappe.log_error")),
+        )
+        stack.enter_context(
+            patch(
+                "frappe.get_cached_doc",
+                side_effect=lambda doctype, name: webhooks[name],
+            )
+        )
+        stack.enter_context(
+            patch(MODULE + ".get_webhook_data", side_effect=get_webhook_data)
+        )
+        stack.enter_context(
+            patch(
+                MODULE + "._settings_cache",
+                return_value={"url": None, "headers": []},
+            )
+        )
+        stack.enter_context(patch("frappe.get_traceback", return_value=""))
+        dispatch_bulk_webhooks(list(webhook_data))
+    return mocks
 
 
 class TestBulkWebhook(unittest.TestCase):
-    pass
+    def test_compute_signature(self):
+        payload = b'{"name": "SAL-ORD-0001"}'
+        expected = base64.b64encode(
+            hmac.new(b"secret", payload, hashlib.sha256).digest()
+        ).decode()
+        self.assertEqual(_compute_signature("secret", payload), expected)
+        self.assertNotEqual(_compute_signature("secret", payload + b" "), expected)
+
+    def test_signature_header_uses_payload(self):
+        payload = b'{"name": "SAL-ORD-0001"}'
+        webhook = frappe._dict(
+            enable_security=1,
+            webhook_headers=[frappe._dict(key="X-Custom", value="1")],
+            get_password=lambda fieldname: "secret",
+        )
+        headers = get_webhook_headers(webhook, payload)
+        self.assertEqual(
+            headers[WEBHOOK_SECRET_HEADER], _compute_signature("secret", payload)
+        )
+        self.assertEqual(headers["X-Custom"], "1")
+
+    def test_session_does_not_store_cookies(self):
+        msg = HTTPMessage()
+        msg["Set-Cookie"] = "sid=abc; Path=/"
+        raw = MagicMock()
+        raw._original_response.msg = msg
+        request = requests.Request("POST", "https://example.com/hook").prepare()
+
+        extract_cookies_to_jar(_SESSION.cookies, request, raw)
+
+        self.assertEqual(len(_SESSION.cookies), 0)
+
+    def test_settings_headers_used_without_webhook_headers(self):
+        webhook = frappe._dict(enable_security=0, webhook_headers=[])
+        settings = {
+            "url": "https://example.com",
+            "headers": [{"key": "Authorization", "value": "token abc"}],
+        }
+        with patch(MODULE + "._settings_cache", return_value=settings):
+            headers = get_webhook_headers(webhook, b"{}")
+
+        self.assertEqual(headers, {"Authorization": "token abc"})
+
+    def test_method_rows_are_not_modified(self):
+        posting_date = datetime.date(2024, 1, 31)
+        rows = [{"name": "SAL-ORD-0001", "posting_date": posting_date}]
+        webhook = frappe._dict(
+            source="Method",
+            group_by=None,
+            webhook_json='{"data": {{ data }}}',
+            get_method_data=lambda method_parameters: rows,
+        )
+        with patch(MODULE + ".get_context") as get_context, patch(
+            "frappe.render_template", return_value='{"ok": 1}'
+        ):
+            data_list = get_webhook_data(webhook)
+
+        self.assertEqual(data_list, [["None", {"ok": 1}]])
+        sent_rows = get_context.call_args[0][0]
+        self.assertEqual(sent_rows[0]["posting_date"], "2024-01-31")
+        self.assertIs(rows[0]["posting_date"], posting_date)
+
+    def test_dumps_non_string_keys(self):
+        self.assertEqual(_dumps({1: "a", None: "b"}), b'{"1":"a","null":"b"}')
+
+    def test_retry_after_is_capped(self):
+        response = MagicMock(headers={"Retry-After": "3600"})
+        response.getheader.return_value = "3600"
+        self.assertEqual(_RETRY.get_retry_after(response), MAX_RETRY_AFTER)
+
+    def test_backoff_is_jittered(self):
+        with patch.object(Retry, "get_backoff_time", return_value=4):
+            backoffs = {_RETRY.get_backoff_time() for i in range(20)}
+
+        self.assertTrue(all(2 <= backoff <= 4 for backoff in backoffs))
+        self.assertGreater(len(backoffs), 1)
+
+    def test_response_data_with_non_json_body(self):
+        res = MagicMock(text="Internal Server Error")
+        res.json.side_effect = ValueError
+        self.assertEqual(get_response_data(res), "Internal Server Error")
+
+    def test_response_data_with_json_body(self):
+        res = MagicMock()
+        res.json.return_value = {"success": True}
+        self.assertEqual(get_response_data(res), {"success": True})
+
+    def test_response_data_without_response(self):
+        self.assertIsNone(get_response_data(None))
+
+    def test_dispatch_sends_first_row_only(self):
+        mocks = dispatch({"HOOK-1": [["A", {"row": 1}], ["B", {"row": 2}]]})
+
+        mocks.request.assert_called_once()
+        self.assertEqual(mocks.request.call_args.kwargs["data"], _dumps({"row": 1}))
+        mocks.log_request.assert_called_once_with(
+            "https://example.com/HOOK-1", {}, {"row": 1}, {"success": True}
+        )
+
+    def test_dispatch_failing_webhook_does_not_block_others(self):
+        mocks = dispatch(
+            {
+                "HOOK-1": Exception("Report failed"),
+                "HOOK-2": [["None", {"row": 1}]],
+            }
+        )
+
+        self.assertEqual(mocks.db.savepoint.call_count, 2)
+        mocks.db.rollback.assert_called_once_with(save_point=DISPATCH_SAVEPOINT)
+        mocks.log_error.assert_called_once()
+        mocks.request.assert_called_once()
+        self.assertEqual(
+            mocks.request.call_args.kwargs["url"], "https://example.com/HOOK-2"
+        )
+
+    def test_dispatch_logs_each_request_once(self):
+        mocks = dispatch(
+            {name: [["None", {"row": name}]] for name in ("HOOK-1", "HOOK-2", "HOOK-3")}
+        )
+
+        self.assertEqual(mocks.request.call_count, 3)
+        self.assertEqual(
+            sorted(call.args[0] for call in mocks.log_request.call_args_list),
+            [
+                "https://example.com/HOOK-1",
+                "https://example.com/HOOK-2",
+                "https://example.com/HOOK-3",
+            ],
+        )
+
+    def test_webhook_headers_take_precedence_over_settings(self):
+        webhook = frappe._dict(
+            enable_security=0,
+            webhook_headers=[
+                frappe._dict(key="Content-Type", value="application/json"),
+                frappe._dict(key="X-Empty", value=None),
+            ],
+        )
+        with patch(MODULE + "._settings_cache") as settings_cache:
+            headers = get_webhook_headers(webhook, b"{}")
+
+        settings_cache.assert_not_called()
+        self.assertEqual(headers, {"Content-Type": "application/json"})
+
+    def get_report_data(self, webhook_json):
+        webhook = frappe._dict(
+            report="Sales Register",
+            report_type="Script Report",
+            filters=None,
+            data_modified_till=0,
+            user="Administrator",
+            send_if_data=0,
+            webhook_json=webhook_json,
+            dynamic_date_filters_set=lambda: False,
+        )
+        report = MagicMock()
+        report.get_data.return_value = ([], [{"name": "A"}, {"name": "B"}])
+        with patch("frappe.get_doc", return_value=report):
+            return BulkWebhook.get_report_data(webhook)
+
+    def test_report_rows_get_idx_when_template_uses_it(self):
+        data = self.get_report_data('[{% for row in data %}{{ row.idx }}{% endfor %}]')
+        self.assertEqual([row["idx"] for row in data], [1, 2])
+
+    def test_report_rows_skip_idx_when_template_does_not_use_it(self):
+        data = self.get_report_data(
+            '[{% for row in data %}"{{ row.name }}"{% endfor %}]'
+        )
+        self.assertTrue(all("idx" not in row for row in data))
+
+    def test_enqueue_bulk_webhook_uses_doc_json(self):
+        doc = {"doctype": "Bulk Webhook", "name": "HOOK-0001", "source": "Method"}
+        webhook = frappe._dict(doc)
+        with patch("frappe.get_doc", return_value=webhook) as get_doc, patch(
+            "frappe.get_cached_doc"
+        ) as get_cached_doc, patch(
+            MODULE + ".get_webhook_data", return_value=None
+        ) as get_webhook_data:
+            enqueue_bulk_webhook(doc_json=json.dumps(doc))
+
+        get_doc.assert_called_once_with(doc)
+        get_cached_doc.assert_not_called()
+        get_webhook_data.assert_called_once_with(webhook, None, None)
+
+    def test_report_uses_saved_filters(self):
+        webhook = frappe._dict(
+            report="Sales Register",
+            report_type="Script Report",
+            filters='{"company": "Aakvatech"}',
+            data_modified_till=0,
+            user="Administrator",
+            send_if_data=0,
+            webhook_json="",
+            dynamic_date_filters_set=lambda: False,
+        )
+        report = MagicMock()
+        report.get_data.return_value = ([], [])
+        with patch("frappe.get_doc", return_value=report):
+            BulkWebhook.get_report_data(webhook)
+            self.assertEqual(
+                report.get_data.call_args.kwargs["filters"], {"company": "Aakvatech"}
+            )
+
+            BulkWebhook.get_report_data(webhook, {"company": "Other"})
+            self.assertEqual(
+                report.get_data.call_args.kwargs["filters"], {"company": "Other"}
+            )
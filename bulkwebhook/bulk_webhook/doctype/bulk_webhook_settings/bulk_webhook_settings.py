@@ -1,9 +1,10 @@
 # Copyright (c) 2021, Aakvatech and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 
 class BulkWebhookSettings(Document):
-    pass
+    def on_update(self):
+        frappe.cache().delete_value("bulk_webhook_settings_cache")